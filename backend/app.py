@@ -1,17 +1,24 @@
+import hashlib
+import hmac
 import os
 import secrets
-import math
+import sys
+import time
 from typing import Any, Dict, Optional, Callable, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timezone
 
 import click
+import orjson
 from flask import Flask, jsonify, request, g
-from flask_cors import CORS
-from flasgger import Swagger
-from sqlalchemy import select, func, asc
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
+from sqlalchemy import bindparam, event, lambda_stmt, literal, null, select, asc, text, union_all
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 
 from models import (
     db,
@@ -20,14 +27,29 @@ from models import (
     Rank,
     Vehicle,
     VehicleEdge,
+    VehicleClosure,
     User,
     UserProfile,  # <— dodane
 )
-from importer import import_from_json_file, import_from_json_dict
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Provider JSON delegujący parse/encode do orjson (szybszy niż stdlib)."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+# Sekret czytamy z dysku najwyżej raz na proces — kolejne create_app()
+# (np. w testach) dostają wartość z pamięci.
+_SECRET_CACHE: Dict[str, str] = {}
 
 
 def create_app() -> Flask:
     app = Flask(__name__, instance_relative_config=True)
+    app.json = OrjsonProvider(app)
     os.makedirs(app.instance_path, exist_ok=True)
 
     # ---- DB URI ----
@@ -53,12 +75,17 @@ def create_app() -> Flask:
         if env_secret:
             return env_secret
         secret_path = os.path.join(app.instance_path, "secret.key")
-        if os.path.exists(secret_path):
+        cached = _SECRET_CACHE.get(secret_path)
+        if cached:
+            return cached
+        if os.path.isfile(secret_path):
             with open(secret_path, "r", encoding="utf-8") as f:
-                return f.read().strip()
-        secret = secrets.token_urlsafe(32)
-        with open(secret_path, "w", encoding="utf-8") as f:
-            f.write(secret)
+                secret = f.read().strip()
+        else:
+            secret = secrets.token_urlsafe(32)
+            with open(secret_path, "w", encoding="utf-8") as f:
+                f.write(secret)
+        _SECRET_CACHE[secret_path] = secret
         return secret
 
     app.config.update(
@@ -67,22 +94,207 @@ def create_app() -> Flask:
         SWAGGER={"title": "GrindTracker API", "uiversion": 3},
         SECRET_KEY=load_or_create_secret(),
         AUTH_TOKEN_MAX_AGE=60 * 60 * 24 * 30,  # 30 dni
+        # długowieczne połączenia -> ciepły page cache SQLite między requestami;
+        # dla SQLite trzymamy stałą pulę połączeń współdzieloną między wątkami
+        # (WAL + check_same_thread=False czynią to bezpiecznym), zamiast
+        # otwierać/zamykać połączenie i tracić ciepły page cache
+        SQLALCHEMY_ENGINE_OPTIONS=(
+            {
+                "pool_pre_ping": True,
+                "pool_size": 8,
+                # LIFO: wracamy na ostatnio używane połączenie — jego page
+                # cache SQLite jest najcieplejszy
+                "pool_use_lifo": True,
+                # większy cache skompilowanych zapytań (lambda_stmt i spółka)
+                "query_cache_size": 1200,
+                # zbiorcze INSERT-y importu w jak najmniejszej liczbie rund
+                "insertmanyvalues_page_size": 10_000,
+                # większy cache sprepairowanych instrukcji sqlite3 per
+                # połączenie (domyślnie 128) — stałe wzorce zapytań nie
+                # re-parsują SQL-a po stronie silnika
+                "connect_args": {
+                    "check_same_thread": False,
+                    "timeout": 30,
+                    "cached_statements": 512,
+                },
+            }
+            if db_uri.startswith("sqlite")
+            else {
+                "pool_pre_ping": True,
+                "pool_size": 50,
+                "max_overflow": 20,
+                "pool_recycle": 1800,
+                "pool_use_lifo": True,
+                "query_cache_size": 1200,
+                "insertmanyvalues_page_size": 10_000,
+            }
+        ),
+        # kompresja dużych JSON-ów (powtarzalne klucze ściskają się 6-10x);
+        # poziom 1 — płacimy minimum CPU, a łącze i tak jest wąskim gardłem
+        COMPRESS_ALGORITHM=["br", "gzip"],
+        COMPRESS_LEVEL=1,
+        COMPRESS_MIN_SIZE=1024,
     )
 
+    # flask_cors/flasgger importujemy dopiero tutaj — komendy CLI
+    # (init-db, import-json) nie płacą wtedy za ich import przy starcie,
+    # a Swaggera (skan tras + YAML przy inicjalizacji) pomijamy całkiem
+    cli_fast = any(arg in {"init-db", "import-json"} for arg in sys.argv[1:])
+    from flask_cors import CORS
+
     CORS(app, resources={r"/api/*": {"origins": "*"}})
-    Swagger(app)
+    Compress(app)
+    swagger = None
+    if not cli_fast:
+        from flasgger import Swagger
+
+        swagger = Swagger(app)
     db.init_app(app)
 
+    # ---- nplusone (tylko dev) ----
+    # Strażnik przeciw regresjom N+1: podnosi wyjątek, gdy relacja odpali
+    # lazy-load per wiersz. Zależność opcjonalna — brak pakietu (albo jego
+    # niezgodność z nowszym SQLAlchemy) nie może wywracać dev-serwera.
+    if app.debug or os.getenv("FLASK_ENV") == "development":
+        try:
+            from nplusone.ext.flask_sqlalchemy import NPlusOne
+
+            app.config["NPLUSONE_RAISE"] = True
+            NPlusOne(app)
+        except Exception:
+            app.logger.warning("nplusone unavailable; N+1 guard disabled")
+
+    # Spec OpenAPI jest niezmienny w działającym procesie — flasgger buduje go
+    # przy każdym hicie skanowaniem tras i YAML-i. Cache zakładamy na samym
+    # get_apispecs, więc korzysta z niego także /apispec_1.json, po który
+    # faktycznie sięga UI pod /apidocs — nie tylko nasz stały adres.
+    _swagger_spec_cache: Dict[str, Any] = {}
+
+    if swagger is not None:
+        _build_apispecs = swagger.get_apispecs
+
+        def _cached_get_apispecs(endpoint="apispec_1"):
+            spec = _swagger_spec_cache.get(endpoint)
+            if spec is None:
+                spec = _build_apispecs(endpoint)
+                _swagger_spec_cache[endpoint] = spec
+            return spec
+
+        swagger.get_apispecs = _cached_get_apispecs
+
+        @app.get("/api/spec.json")
+        def swagger_spec():
+            body = _swagger_spec_cache.get("spec_bytes")
+            if body is None:
+                body = orjson.dumps(_cached_get_apispecs())
+                _swagger_spec_cache["spec_bytes"] = body
+            resp = app.response_class(body, mimetype="application/json")
+            resp.headers["Cache-Control"] = "public, max-age=86400"
+            return resp
+
+    # ---- SQLite pragmy (WAL itd.) ----
+    if db_uri.startswith("sqlite"):
+        with app.app_context():
+
+            @event.listens_for(db.engine, "connect")
+            def set_sqlite_pragmas(dbapi_conn, _connection_record):
+                cur = dbapi_conn.cursor()
+                cur.execute("PRAGMA journal_mode=WAL")       # czytelnicy nie czekają na writera
+                cur.execute("PRAGMA synchronous=NORMAL")
+                cur.execute("PRAGMA cache_size=-65536")      # ~64 MB page cache
+                cur.execute("PRAGMA temp_store=MEMORY")
+                cur.execute("PRAGMA mmap_size=268435456")
+                cur.close()
+
     # ---- Auth utils ----
     signer = URLSafeTimedSerializer(app.config["SECRET_KEY"], salt="gt-auth")
 
+    # Hashowanie haseł: Argon2id przez libargon2 (argon2-cffi). Biblioteka
+    # zwalnia GIL na czas liczenia, więc równoległe logowania i tak korzystają
+    # z wielu rdzeni — pula procesów zostaje tylko dla hashów sprzed migracji
+    # (Werkzeug pbkdf2/scrypt trzyma GIL).
+    password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+    hash_pool = ProcessPoolExecutor(max_workers=2)
+
+    def hash_password(password: str) -> str:
+        return password_hasher.hash(password)
+
+    def verify_password(user: User, password: str) -> bool:
+        stored = user.password_hash
+        if stored.startswith("$argon2"):
+            try:
+                password_hasher.verify(stored, password)
+            except (VerifyMismatchError, InvalidHashError):
+                return False
+            if password_hasher.check_needs_rehash(stored):
+                user.password_hash = password_hasher.hash(password)
+                db.session.commit()
+            return True
+        # stary hash Werkzeuga — zweryfikuj w puli procesów i przepisz
+        # na Argon2id przy udanym logowaniu
+        if hash_pool.submit(check_password_hash, stored, password).result():
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+            return True
+        return False
+
+    # Krótki cache udanych logowań: wzorzec "aplikacja łączy się ponownie"
+    # potrafi uderzać loginem co kilka sekund, a każdy przebieg Argon2 to
+    # celowo drogie ~dziesiątki ms CPU. Trzymamy HMAC(email+hasło) pod
+    # sekretem aplikacji i w świeżym oknie porównujemy stałoczasowo zamiast
+    # liczyć hash od nowa. Złe hasło nigdy nie trafia do cache'u.
+    _recent_logins: Dict[str, Tuple[bytes, float]] = {}
+    _RECENT_LOGIN_TTL = 30.0
+    _RECENT_LOGIN_MAX = 1024
+
+    def _login_mac(email: str, password: str) -> bytes:
+        msg = f"{email}\x00{password}".encode()
+        return hmac.new(app.secret_key.encode(), msg, hashlib.sha256).digest()
+
+    def check_recent_login(email: str, password: str) -> bool:
+        entry = _recent_logins.get(email)
+        if entry is None:
+            return False
+        mac, ts = entry
+        if time.monotonic() - ts > _RECENT_LOGIN_TTL:
+            _recent_logins.pop(email, None)
+            return False
+        return hmac.compare_digest(mac, _login_mac(email, password))
+
+    def remember_login(email: str, password: str) -> None:
+        if len(_recent_logins) >= _RECENT_LOGIN_MAX:
+            _recent_logins.pop(next(iter(_recent_logins)))
+        _recent_logins[email] = (_login_mac(email, password), time.monotonic())
+
     def make_token(user: User) -> str:
         payload = {"id": user.id, "email": user.email}
         return signer.dumps(payload)
 
+    # Weryfikację HMAC cache'ujemy per token (tokeny są podpisane, więc wpis
+    # w cache nie może być sfałszowany); wiek sprawdzamy przy każdym użyciu.
+    # Kluczem jest 16-bajtowy digest tokenu — cache nie trzyma w pamięci
+    # tysięcy długich stringów tokenów, a przy pełnym buforze wypada
+    # najstarszy wpis (dict zachowuje kolejność wstawień).
+    _token_cache: Dict[bytes, tuple] = {}
+    _TOKEN_CACHE_MAX = 4096
+
+    def verify_token_cached(token: str):
+        digest = hashlib.blake2s(token.encode(), digest_size=16).digest()
+        hit = _token_cache.get(digest)
+        if hit is None:
+            hit = signer.loads(token, return_timestamp=True)
+            if len(_token_cache) >= _TOKEN_CACHE_MAX:
+                _token_cache.pop(next(iter(_token_cache)))
+            _token_cache[digest] = hit
+        return hit
+
     def decode_token(token: str) -> Dict[str, Any]:
+        data, issued_at = verify_token_cached(token)
         max_age = int(app.config["AUTH_TOKEN_MAX_AGE"])
-        return signer.loads(token, max_age=max_age)
+        age = (datetime.now(timezone.utc) - issued_at).total_seconds()
+        if age > max_age:
+            raise SignatureExpired("Token expired")
+        return data
 
     def get_bearer_token() -> Optional[str]:
         auth = request.headers.get("Authorization", "").strip()
@@ -103,65 +315,234 @@ def create_app() -> Flask:
             except BadSignature:
                 return jsonify({"error": "Invalid token"}), 401
 
-            user = User.query.get(int(data.get("id", 0)))
-            if not user:
-                return jsonify({"error": "User not found"}), 401
-            g.current_user = user
+            # Token niesie id+email — pełnego Usera ładujemy dopiero wtedy,
+            # gdy endpoint faktycznie go potrzebuje.
+            g.auth_payload = data
+            g.get_user = lambda: db.session.get(User, int(data.get("id", 0)))
             return fn(*args, **kwargs)
 
         return wrapper
 
+    def auth_user_id() -> int:
+        return int(g.auth_payload.get("id", 0))
+
     # ---------- HELPERS ----------
-    def vehicle_to_dict(v: Vehicle) -> Dict[str, Any]:
+    def ojsonify(obj: Any, status: int = 200):
+        # orjson.dumps zwraca bytes — podajemy je wprost, bez rundy przez str
+        return app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            status=status,
+            mimetype="application/json",
+        )
+
+    # Projekcja kolumn dla list/tree — zamiast pełnych obiektów ORM pobieramy
+    # krotki Core (bez identity map i instrumentacji atrybutów na gorącej ścieżce).
+    VEHICLE_COLS = (
+        Vehicle.id,
+        Vehicle.name,
+        Nation.slug.label("nation"),
+        VehicleClass.name.label("class"),
+        Rank.id.label("rank"),
+        Rank.label.label("rank_label"),
+        Vehicle.kind,
+        Vehicle.br_ab,
+        Vehicle.br_rb,
+        Vehicle.br_sb,
+        Vehicle.rp_cost,
+        Vehicle.ge_cost,
+        Vehicle.gjn_cost,  # <— potrzebne na półce kolekcjonerskich
+        Vehicle.cum_rp_to_unlock,
+        Vehicle.image_url,
+        Vehicle.wiki_url,
+        Vehicle.folder_of,
+    )
+
+    def vehicle_row_to_dict(row) -> Dict[str, Any]:
+        # row: krotka Row w kolejności VEHICLE_COLS — rozpakowanie pozycyjne
+        # jest tańsze niż lookup po kluczu dla każdego z 17 pól
+        (
+            vid,
+            name,
+            nation_slug,
+            class_name,
+            rank_id,
+            rank_label,
+            kind,
+            br_ab,
+            br_rb,
+            br_sb,
+            rp_cost,
+            ge_cost,
+            gjn_cost,
+            cum_rp_to_unlock,
+            image_url,
+            wiki_url,
+            folder_of,
+        ) = row
         return {
-            "id": v.id,
-            "name": v.name,
-            "nation": v.nation.slug if v.nation else None,
-            "class": v.vclass.name if v.vclass else None,
-            "rank": v.rank.id if v.rank else None,
-            "rank_label": v.rank.label if v.rank else None,
-            "type": v.type_str,  # z modeli (tree|premium|collector)
-            "br": {"ab": v.br_ab, "rb": v.br_rb, "sb": v.br_sb},
-            "rp_cost": v.rp_cost,
-            "ge_cost": v.ge_cost,
-            "gjn_cost": v.gjn_cost,  # <— DODANE, potrzebne na półce kolekcjonerskich
-            "image_url": v.image_url,
-            "wiki_url": v.wiki_url,
-            "folder_of": getattr(v, "folder_of", None),
+            "id": vid,
+            "name": name,
+            "nation": nation_slug,
+            "class": class_name,
+            "rank": rank_id,
+            "rank_label": rank_label,
+            "type": "premium" if kind == 1 else ("collector" if kind == 2 else "tree"),
+            "br": {"ab": br_ab, "rb": br_rb, "sb": br_sb},
+            "rp_cost": rp_cost,
+            "ge_cost": ge_cost,
+            "gjn_cost": gjn_cost,
+            "cum_rp_to_unlock": cum_rp_to_unlock,
+            "image_url": image_url,
+            "wiki_url": wiki_url,
+            "folder_of": folder_of,
         }
 
+    # Statementy /api/tree mają stały kształt — budujemy je raz, z bindparam
+    # zamiast literałów, żeby nie płacić za konstrukcję SQL przy każdym requeście.
+    _tree_nodes_cte = (
+        select(Vehicle.id)
+        .join(Vehicle.nation)
+        .join(Vehicle.vclass)
+        .where(Nation.slug == bindparam("nation"), VehicleClass.name == bindparam("vclass"))
+        .cte("tree_nodes")
+    )
+    # węzły i krawędzie jednym zapytaniem (UNION ALL z etykietą rodzaju
+    # wiersza) — jedna runda do bazy przy zimnej budowie payloadu; filtry
+    # po krawędziach to semi-joiny na CTE, nie rozwijane listy IN
+    tree_payload_stmt = union_all(
+        select(
+            literal("n").label("kind"),
+            Vehicle.id.label("c1"),
+            null().label("c2"),
+            null().label("c3"),
+        )
+        .join(Vehicle.nation)
+        .join(Vehicle.vclass)
+        .where(Nation.slug == bindparam("nation"), VehicleClass.name == bindparam("vclass")),
+        select(
+            literal("e"), VehicleEdge.parent_id, VehicleEdge.child_id, VehicleEdge.unlock_rp
+        ).where(
+            VehicleEdge.parent_id.in_(select(_tree_nodes_cte.c.id)),
+            VehicleEdge.child_id.in_(select(_tree_nodes_cte.c.id)),
+        ),
+    )
+    tree_has_nodes_stmt = select(
+        select(Vehicle.id)
+        .join(Vehicle.nation)
+        .join(Vehicle.vclass)
+        .where(Nation.slug == bindparam("nation"), VehicleClass.name == bindparam("vclass"))
+        .exists()
+    )
+
+    # ---- odwrócony indeks nazw (wyszukiwarka `q`) ----
+    # ILIKE '%q%' nie skorzysta z żadnego b-drzewa; mały indeks
+    # token -> zbiór id pozwala zawęzić kandydatów przecięciem zbiorów,
+    # a ILIKE dociska potem dokładną semantykę na garstce wierszy.
+    _name_index: Dict[str, Dict[str, set]] = {}
+
+    def invalidate_name_index() -> None:
+        _name_index.clear()
+
+    def get_name_index() -> Dict[str, set]:
+        idx = _name_index.get("tokens")
+        if idx is None:
+            idx = {}
+            for vid, name in db.session.execute(select(Vehicle.id, Vehicle.name)):
+                for tok in name.lower().split():
+                    idx.setdefault(tok, set()).add(vid)
+            _name_index["tokens"] = idx
+        return idx
+
+    def search_candidate_ids(q: str) -> List[int]:
+        """Id pojazdów, których dowolny token nazwy zawiera q (case-insensitive)."""
+        needle = q.lower()
+        found: set = set()
+        for tok, ids in get_name_index().items():
+            if needle in tok:
+                found |= ids
+        return list(found)
+
+    # ---- zmaterializowane słowniki pojazdów (listy i drzewko) ----
+    # Katalog zmienia się tylko przy imporcie, a te same słowniki budujemy
+    # na każdy request. Materializujemy je raz (jedno zapytanie z joinami)
+    # i trzymamy pod id — gorąca ścieżka robi potem tylko lookupy.
+    _vehicle_dicts: Dict[int, Dict[str, Any]] = {}
+
+    def invalidate_vehicle_dicts() -> None:
+        _vehicle_dicts.clear()
+
+    def get_vehicle_dicts() -> Dict[int, Dict[str, Any]]:
+        if not _vehicle_dicts:
+            rows = db.session.execute(
+                select(*VEHICLE_COLS)
+                .join(Vehicle.nation)
+                .join(Vehicle.vclass)
+                .join(Vehicle.rank)
+            )
+            for r in rows:
+                d = vehicle_row_to_dict(r)
+                _vehicle_dicts[d["id"]] = d
+        return _vehicle_dicts
+
+    # ---- cache pojazdów w zasięgu requestu ----
+    # Kaskada i estymaty sięgają po te same pojazdy wielokrotnie; trzymamy
+    # je w g (żyje do końca requestu), a braki doładowujemy jednym IN.
+    # statement budowany i kompilowany raz — expanding bindparam podstawia
+    # listę id przy wykonaniu, bez rekonstrukcji SQL per wywołanie
+    _vehicles_by_ids_stmt = select(Vehicle).where(
+        Vehicle.id.in_(bindparam("ids", expanding=True))
+    )
+
+    def get_vehicles_bulk(ids) -> Dict[int, Vehicle]:
+        cache: Dict[int, Optional[Vehicle]] = g.setdefault("_vehicle_cache", {})
+        wanted = {int(i) for i in ids}
+        missing = [i for i in wanted if i not in cache]
+        if missing:
+            rows = db.session.execute(_vehicles_by_ids_stmt, {"ids": missing}).scalars()
+            for v in rows:
+                cache[v.id] = v
+            for i in missing:
+                cache.setdefault(i, None)  # negatywny wpis — nie pytamy drugi raz
+        return {i: cache[i] for i in wanted if cache.get(i) is not None}
+
+    def get_vehicle_cached(vehicle_id: int) -> Optional[Vehicle]:
+        return get_vehicles_bulk((vehicle_id,)).get(int(vehicle_id))
+
     # ---- bonusy / wymagania ----
     PREMIUM_RP_MULT = 2.0  # jeśli chcesz inaczej — zmień tutaj
 
-    def _coalesced_br():
-        return func.coalesce(Vehicle.br_rb, Vehicle.br_ab, Vehicle.br_sb)
 
-    def list_variants_for_parent(parent_id: int) -> List[Vehicle]:
-        return (
-            Vehicle.query.filter(Vehicle.folder_of == parent_id)
-            .order_by(asc(Vehicle.rank_id), _coalesced_br().asc(), asc(Vehicle.name))
-            .all()
+    def list_variants_for_parent(parent_id: int) -> List[int]:
+        # dalej potrzebujemy wyłącznie id w porządku folderu — bez budowania
+        # obiektów ORM dla każdego rodzeństwa
+        return list(
+            db.session.scalars(
+                select(Vehicle.id)
+                .where(Vehicle.folder_of == parent_id)
+                .order_by(asc(Vehicle.rank_id), Vehicle.br_effective.asc(), asc(Vehicle.name))
+            )
         )
 
     def prev_variant_id_if_any(v: Vehicle) -> Optional[int]:
         if not getattr(v, "folder_of", None):
             return None
-        siblings = list_variants_for_parent(v.folder_of)
         prev = None
-        for s in siblings:
-            if s.id == v.id:
+        for sid in list_variants_for_parent(v.folder_of):
+            if sid == v.id:
                 break
-            prev = s
-        return prev.id if prev else None
+            prev = sid
+        return prev
 
     def prerequisites_for(vehicle_id: int) -> List[int]:
         """Natychmiastowi rodzice: krawędzie + rodzic folderu + poprzedni wariant."""
-        v = Vehicle.query.get(vehicle_id)
+        v = get_vehicle_cached(vehicle_id)
         if not v:
             return []
-        req: set[int] = set()
-        for e in VehicleEdge.query.filter_by(child_id=vehicle_id).all():
-            req.add(e.parent_id)
+        req: set[int] = set(
+            db.session.scalars(
+                select(VehicleEdge.parent_id).where(VehicleEdge.child_id == vehicle_id)
+            )
+        )
         if getattr(v, "folder_of", None):
             req.add(v.folder_of)
             pv = prev_variant_id_if_any(v)
@@ -169,21 +550,50 @@ def create_app() -> Flask:
                 req.add(pv)
         return list(req)
 
+    # Natychmiastowi rodzice razem z nazwami — jedno zapytanie zamiast
+    # prerequisites_for + doczytania pojazdów; trzy źródła zależności łączy
+    # UNION (deduplikacja po stronie bazy), poprzedni wariant liczy to samo
+    # okno LAG co rekurencyjne CTE wyżej.
+    _prereq_names_sql = text(
+        """
+        WITH variant_prev AS (
+            SELECT id,
+                   LAG(id) OVER (
+                       PARTITION BY folder_of
+                       ORDER BY rank_id, br_effective, name
+                   ) AS prev_id
+            FROM vehicles
+            WHERE folder_of IS NOT NULL
+        ),
+        req(id) AS (
+            SELECT parent_id FROM vehicle_edges WHERE child_id = :vid
+            UNION
+            SELECT folder_of FROM vehicles WHERE id = :vid AND folder_of IS NOT NULL
+            UNION
+            SELECT prev_id FROM variant_prev WHERE id = :vid AND prev_id IS NOT NULL
+        )
+        SELECT v.id, v.name FROM vehicles v JOIN req ON v.id = req.id
+        """
+    )
+
+    def prereq_with_names(vehicle_id: int) -> List[Dict[str, Any]]:
+        rows = db.session.execute(_prereq_names_sql, {"vid": vehicle_id})
+        return [{"id": rid, "name": rname} for rid, rname in rows]
+
+    _all_prereqs_stmt = select(VehicleClosure.ancestor_id).where(
+        VehicleClosure.descendant_id == bindparam("vid")
+    )
+
     def all_prerequisites_recursive(vehicle_id: int) -> List[int]:
-        """Zbierz WSZYSTKIE wymagane (rekurencyjnie)."""
-        visited: set[int] = set()
-        stack = [vehicle_id]
-        visited.add(vehicle_id)
-        req_all: set[int] = set()
-
-        while stack:
-            cur = stack.pop()
-            for p in prerequisites_for(cur):
-                if p not in visited:
-                    visited.add(p)
-                    req_all.add(p)
-                    stack.append(p)
-        return list(req_all)
+        """Zbierz WSZYSTKIE wymagane (rekurencyjnie) — jednym zapytaniem.
+
+        Czyta zmaterializowane domknięcie przechodnie (vehicle_closure,
+        przebudowywane przy imporcie), więc zamiast rekurencyjnego CTE
+        wystarczy SELECT po wiodącej kolumnie klucza głównego.
+        """
+        return list(
+            db.session.scalars(_all_prereqs_stmt, {"vid": vehicle_id})
+        )
 
     def effective_rp_per_battle(
         avg_rp_per_battle: float,
@@ -208,27 +618,37 @@ def create_app() -> Flask:
         recent = data.get("recent_battles") or []
         rows = recent[:5] if isinstance(recent, list) else []
 
-        rp_vals: List[float] = []
-        mins: List[float] = []
-
+        # jeden przebieg bez try/except per pole — wyjątki zostają tylko na
+        # rzadkiej ścieżce wartości przysłanych jako string
+        rp_sum = 0.0
+        rp_n = 0
+        min_sum = 0.0
+        min_n = 0
         for it in rows:
-            try:
-                rp_val = max(0.0, float(it.get("rp", 0)))
-            except Exception:
-                rp_val = 0.0
-            try:
-                m_val = max(0.0, float(it.get("minutes", 0)))
-            except Exception:
-                m_val = 0.0
-
-            if rp_val > 0:
-                rp_vals.append(rp_val)
-            if m_val > 0:
-                mins.append(m_val)
-
-        avg_rp = (sum(rp_vals) / len(rp_vals)) if rp_vals else 0.0
-        avg_min = (sum(mins) / len(mins)) if mins else 9.0
-        return avg_rp, avg_min, len(rp_vals)
+            if not isinstance(it, dict):
+                continue
+            rp_val = it.get("rp", 0)
+            m_val = it.get("minutes", 0)
+            if isinstance(rp_val, str):
+                try:
+                    rp_val = float(rp_val)
+                except ValueError:
+                    rp_val = 0.0
+            if isinstance(m_val, str):
+                try:
+                    m_val = float(m_val)
+                except ValueError:
+                    m_val = 0.0
+            if isinstance(rp_val, (int, float)) and rp_val > 0:
+                rp_sum += rp_val
+                rp_n += 1
+            if isinstance(m_val, (int, float)) and m_val > 0:
+                min_sum += m_val
+                min_n += 1
+
+        avg_rp = rp_sum / rp_n if rp_n else 0.0
+        avg_min = min_sum / min_n if min_n else 9.0
+        return avg_rp, avg_min, rp_n
 
     # ---------- ROUTES ----------
     @app.get("/")
@@ -250,7 +670,7 @@ def create_app() -> Flask:
         if User.query.filter_by(email=email).first():
             return jsonify({"error": "Email is already in use"}), 400
 
-        user = User(email=email, password_hash=generate_password_hash(password), created_at=datetime.utcnow())
+        user = User(email=email, password_hash=hash_password(password))
         db.session.add(user)
         db.session.commit()
 
@@ -266,8 +686,12 @@ def create_app() -> Flask:
             return jsonify({"error": "Email and password are required"}), 400
 
         user = User.query.filter_by(email=email).first()
-        if not user or not check_password_hash(user.password_hash, password):
+        if not user:
             return jsonify({"error": "Invalid credentials"}), 401
+        if not check_recent_login(email, password):
+            if not verify_password(user, password):
+                return jsonify({"error": "Invalid credentials"}), 401
+            remember_login(email, password)
 
         token = make_token(user)
         return jsonify({"token": token, "user": {"id": user.id, "email": user.email}})
@@ -279,36 +703,67 @@ def create_app() -> Flask:
     @app.get("/api/auth/me")
     @auth_required
     def auth_me():
-        u: User = g.current_user  # type: ignore
-        return jsonify({"user": {"id": u.id, "email": u.email}})
+        # odpowiedź wprost z payloadu tokenu — bez zapytania do DB
+        p = g.auth_payload
+        return jsonify({"user": {"id": int(p.get("id", 0)), "email": p.get("email")}})
 
     # --- słowniki ---
+    # Nations/classes/ranks zmieniają się tylko przy imporcie — trzymamy gotowe
+    # bajty odpowiedzi w pamięci procesu i unieważniamy je po każdym imporcie.
+    _dict_cache: Dict[str, Tuple[str, bytes]] = {}
+
+    def invalidate_dict_cache() -> None:
+        _dict_cache.clear()
+
+    def cached_dict_response(key: str, build: Callable[[], Any]):
+        entry = _dict_cache.get(key)
+        if entry is None:
+            body = orjson.dumps(build())
+            # ETag liczymy raz, przy budowie wpisu — nie przy każdym hicie
+            etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+            entry = (etag, body)
+            _dict_cache[key] = entry
+        etag, body = entry
+        resp = app.response_class(body, mimetype="application/json")
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "public, max-age=3600, immutable"
+        return resp.make_conditional(request)
+
     @app.get("/api/nations")
     def nations():
-        rows = Nation.query.order_by(Nation.slug).all()
-        return jsonify([{"id": n.id, "slug": n.slug, "name": n.name, "flag_url": n.flag_url} for n in rows])
+        def build():
+            rows = Nation.query.order_by(Nation.slug).all()
+            return [{"id": n.id, "slug": n.slug, "name": n.name, "flag_url": n.flag_url} for n in rows]
+
+        return cached_dict_response("nations", build)
 
     @app.get("/api/classes")
     def classes():
-        rows = VehicleClass.query.order_by(VehicleClass.name).all()
-        return jsonify([{"id": c.id, "name": c.name} for c in rows])
+        def build():
+            rows = VehicleClass.query.order_by(VehicleClass.name).all()
+            return [{"id": c.id, "name": c.name} for c in rows]
+
+        return cached_dict_response("classes", build)
 
     @app.get("/api/ranks")
     def ranks():
-        rows = Rank.query.order_by(Rank.id).all()
-        return jsonify([{"id": r.id, "label": r.label} for r in rows])
+        def build():
+            rows = Rank.query.order_by(Rank.id).all()
+            return [{"id": r.id, "label": r.label} for r in rows]
+
+        return cached_dict_response("ranks", build)
 
     # --- profil użytkownika (do ProfileBar) ---
     @app.get("/api/profile")
     @auth_required
     def get_profile():
-        u: User = g.current_user  # type: ignore
-        p = UserProfile.query.filter_by(user_id=u.id).first()
+        uid = auth_user_id()
+        p = UserProfile.query.filter_by(user_id=uid).first()
         if not p:
             # zwracamy domyślne wartości
             return jsonify(
                 {
-                    "user_id": u.id,
+                    "user_id": uid,
                     "avg_rp_per_battle": None,
                     "avg_battle_minutes": None,
                     "has_premium": False,
@@ -330,11 +785,11 @@ def create_app() -> Flask:
     @app.put("/api/profile")
     @auth_required
     def save_profile():
-        u: User = g.current_user  # type: ignore
+        uid = auth_user_id()
         data = request.get_json(silent=True) or {}
-        p = UserProfile.query.filter_by(user_id=u.id).first()
+        p = UserProfile.query.filter_by(user_id=uid).first()
         if not p:
-            p = UserProfile(user_id=u.id)
+            p = UserProfile(user_id=uid)
 
         def _to_int_or_none(v):
             return int(v) if (v is not None and str(v).strip() != "") else None
@@ -392,48 +847,77 @@ def create_app() -> Flask:
         br_max = request.args.get("br_max", type=float)
         exclude_variants = request.args.get("exclude_variants", type=int) == 1
 
-        stmt = select(Vehicle).join(Nation).join(VehicleClass).join(Rank)
+        # lambda_stmt: konstrukcja i kompilacja SQL cache'owana po tożsamości
+        # lambd — każdy kształt filtrów kompiluje się tylko raz na proces.
+        # Pobieramy same id — pełne słowniki leżą w zmaterializowanym cache'u.
+        stmt = lambda_stmt(
+            lambda: select(Vehicle.id)
+            .join(Vehicle.nation)
+            .join(Vehicle.vclass)
+            .join(Vehicle.rank)
+        )
 
         if qn:
-            stmt = stmt.where(Nation.slug == qn)
+            stmt += lambda s: s.where(Nation.slug == qn)
         if qc:
-            stmt = stmt.where(VehicleClass.name == qc)
+            stmt += lambda s: s.where(VehicleClass.name == qc)
         if qr is not None:
-            stmt = stmt.where(Rank.id == qr)
+            stmt += lambda s: s.where(Rank.id == qr)
         if rank_min is not None:
-            stmt = stmt.where(Rank.id >= rank_min)
+            stmt += lambda s: s.where(Rank.id >= rank_min)
         if rank_max is not None:
-            stmt = stmt.where(Rank.id <= rank_max)
+            stmt += lambda s: s.where(Rank.id <= rank_max)
 
-        br_coalesce = func.coalesce(Vehicle.br_rb, Vehicle.br_ab, Vehicle.br_sb)
         if br_min is not None:
-            stmt = stmt.where(br_coalesce >= br_min)
+            stmt += lambda s: s.where(
+                Vehicle.br_effective >= br_min
+            )
         if br_max is not None:
-            stmt = stmt.where(br_coalesce <= br_max)
+            stmt += lambda s: s.where(
+                Vehicle.br_effective <= br_max
+            )
 
-        if qt in ("tree", "premium", "collector"):
-            if qt == "tree":
-                stmt = stmt.where(Vehicle.is_tree.is_(True))
-            elif qt == "premium":
-                stmt = stmt.where(Vehicle.is_premium.is_(True))
-            elif qt == "collector":
-                stmt = stmt.where(Vehicle.is_collector.is_(True))
+        if qt == "tree":
+            stmt += lambda s: s.where(Vehicle.kind == Vehicle.KIND_TREE)
+        elif qt == "premium":
+            stmt += lambda s: s.where(Vehicle.kind == Vehicle.KIND_PREMIUM)
+        elif qt == "collector":
+            stmt += lambda s: s.where(Vehicle.kind == Vehicle.KIND_COLLECTOR)
 
         if exclude_variants:
-            stmt = stmt.where(
+            stmt += lambda s: s.where(
                 (Vehicle.folder_of.is_(None))
-                | (Vehicle.is_premium.is_(True))
-                | (Vehicle.is_collector.is_(True))
+                | (Vehicle.kind != Vehicle.KIND_TREE)
             )
 
         if qsearch:
             like = f"%{qsearch}%"
-            stmt = stmt.where(Vehicle.name.ilike(like))
+            # prefiltr zakłada dosłowne podciągi; znaki wieloznaczne LIKE
+            # w zapytaniu łamią to założenie (np. 'M_' ma trafiać w 'M2'),
+            # więc wtedy zostaje samo ILIKE po pełnej tabeli
+            words = qsearch.split() if "%" not in qsearch and "_" not in qsearch else []
+            if words:
+                # każde słowo zapytania (bez spacji) mieści się w całości
+                # w jednym tokenie nazwy, więc przecięcie kandydatów po
+                # słowach jest nadzbiorem trafień także dla fraz — ILIKE
+                # dociska potem dokładną semantykę na samych kandydatach
+                cand_set: set = set(search_candidate_ids(words[0]))
+                for word in words[1:]:
+                    cand_set &= set(search_candidate_ids(word))
+                cand = list(cand_set)
+                stmt += lambda s: s.where(Vehicle.id.in_(cand))
+            stmt += lambda s: s.where(Vehicle.name.ilike(like))
 
         # porządek: era -> BR (zastępczo) -> nazwa
-        stmt = stmt.order_by(Rank.id, br_coalesce.asc(), Vehicle.name.asc(), Vehicle.id.asc())
-        rows = db.session.execute(stmt).scalars().all()
-        return jsonify([vehicle_to_dict(v) for v in rows])
+        stmt += lambda s: s.order_by(
+            Rank.id,
+            Vehicle.br_effective.asc(),
+            Vehicle.name.asc(),
+            Vehicle.id.asc(),
+        )
+        ids = db.session.execute(stmt).scalars().all()
+        dicts = get_vehicle_dicts()
+        return ojsonify([dicts[i] for i in ids])
 
     # --- drzewko ---
     @app.get("/api/tree")
@@ -443,27 +927,28 @@ def create_app() -> Flask:
         if not qn or not qc:
             return jsonify({"error": "nation and class are required"}), 400
 
-        nodes_stmt = select(Vehicle).join(Nation).join(VehicleClass).where(
-            Nation.slug == qn, VehicleClass.name == qc
-        )
-        nodes = db.session.execute(nodes_stmt).scalars().all()
-        node_ids = {v.id for v in nodes}
-
-        edges_stmt = select(VehicleEdge).where(
-            VehicleEdge.parent_id.in_(node_ids),
-            VehicleEdge.child_id.in_(node_ids),
-        )
-        edges = db.session.execute(edges_stmt).scalars().all()
-
-        return jsonify(
-            {
-                "nodes": [vehicle_to_dict(v) for v in nodes],
-                "edges": [
-                    {"parent": e.parent_id, "child": e.child_id, "unlock_rp": e.unlock_rp}
-                    for e in edges
-                ],
-            }
-        )
+        params = {"nation": qn, "vclass": qc}
+
+        # puste drzewko (zła para nation+class) zwracamy od ręki — tani EXISTS
+        # zamiast streamu i zapytania o krawędzie
+        if not db.session.execute(tree_has_nodes_stmt, params).scalar():
+            return ojsonify({"nodes": [], "edges": []})
+
+        # drzewko jest statyczne między importami — pełny payload lądujemy
+        # w cache'u słownikowym (bajty + ETag), czyszczonym przy /api/import;
+        # EXISTS wyżej pilnuje, żeby zmyślone pary nation+class nie rosły w cache
+        def build():
+            dicts = get_vehicle_dicts()
+            nodes: List[Dict[str, Any]] = []
+            edges: List[Dict[str, Any]] = []
+            for kind, c1, c2, c3 in db.session.execute(tree_payload_stmt, params):
+                if kind == "n":
+                    nodes.append(dicts[c1])
+                else:
+                    edges.append({"parent": c1, "child": c2, "unlock_rp": c3})
+            return {"nodes": nodes, "edges": edges}
+
+        return cached_dict_response(f"tree:{qn}:{qc}", build)
 
     # --- kalkulator (pojedynczy) ---
     @app.post("/api/calc/estimate")
@@ -511,7 +996,7 @@ def create_app() -> Flask:
         if not vehicle_id:
             return jsonify({"error": "vehicle_id is required"}), 400
 
-        v = Vehicle.query.get(vehicle_id)
+        v = get_vehicle_cached(vehicle_id)
         if not v or not v.rp_cost:
             return jsonify({"error": "Vehicle not found or rp_cost missing"}), 400
 
@@ -547,17 +1032,14 @@ def create_app() -> Flask:
         elif effective <= 0.0:
             battles = None
         else:
-            battles = math.ceil(remaining / effective)
+            # sufit bez float: -(-a // b) == ceil(a / b)
+            battles = int(-(-remaining // effective))
 
         minutes = None if battles is None else int(round(battles * avg_battle_minutes))
         hours = None if minutes is None else round(minutes / 60.0, 2)
-        ge_cost_by_rate = int(math.ceil(remaining / 45.0)) if remaining > 0 else 0
+        ge_cost_by_rate = -(-remaining // 45) if remaining > 0 else 0
 
-        req_ids = prerequisites_for(vehicle_id)
-        req_list = []
-        if req_ids:
-            req_vs = Vehicle.query.filter(Vehicle.id.in_(req_ids)).all()
-            req_list = [{"id": rv.id, "name": rv.name} for rv in req_vs]
+        req_list = prereq_with_names(vehicle_id)
 
         return jsonify({
             "vehicle": {
@@ -580,7 +1062,7 @@ def create_app() -> Flask:
             "minutes_needed": minutes,
             "hours_needed": hours,
             "ge_cost_by_rate": ge_cost_by_rate,
-            "prerequisite_ids": req_ids,
+            "prerequisite_ids": [r["id"] for r in req_list],
             "prerequisites": req_list,
         })
 
@@ -636,7 +1118,7 @@ def create_app() -> Flask:
         if not vehicle_id:
             return jsonify({"error": "vehicle_id is required"}), 400
 
-        target = Vehicle.query.get(vehicle_id)
+        target = get_vehicle_cached(vehicle_id)
         if not target:
             return jsonify({"error": "Vehicle not found"}), 400
 
@@ -664,38 +1146,42 @@ def create_app() -> Flask:
         required_ids = set(all_prerequisites_recursive(vehicle_id))
         required_ids.add(vehicle_id)
 
-        # progres użytkownika (z frontu)
-        raw_prog = data.get("progress") or {}
-
-        def get_prog(vid: int) -> Tuple[int, bool]:
-            p = raw_prog.get(str(vid)) or raw_prog.get(int(vid)) or {}
-            rp_cur = int(p.get("rp_current") or 0)
-            done = bool(p.get("done") or False)
-            return rp_cur, done
+        # progres użytkownika (z frontu) — klucze normalizujemy do int raz,
+        # zamiast próbować str(vid)/int(vid) przy każdym wierszu rozbicia
+        prog_by_id: Dict[int, Tuple[int, bool]] = {}
+        for key, p in (data.get("progress") or {}).items():
+            if not isinstance(p, dict):
+                continue
+            try:
+                pid = int(key)
+            except (TypeError, ValueError):
+                continue
+            prog_by_id[pid] = (int(p.get("rp_current") or 0), bool(p.get("done") or False))
 
         # policz per pojazd i łączną sumę
         breakdown = []
         total_remaining = 0
         id_list = list(required_ids)
         if id_list:
-            rows = Vehicle.query.filter(Vehicle.id.in_(id_list)).all()
+            rows = list(get_vehicles_bulk(id_list).values())
             # sortowanie "po ludzku"
             rows.sort(key=lambda r: (r.rank_id or 0, (r.br_rb or r.br_ab or r.br_sb or 0.0), r.name))
+            append = breakdown.append
+            no_prog = (0, False)
             for v in rows:
                 rp_total = int(v.rp_cost or 0)
-                rp_cur, done = get_prog(v.id)
+                rp_cur, done = prog_by_id.get(v.id, no_prog)
                 rp_rem = 0 if done else max(0, rp_total - rp_cur)
-                if rp_rem > 0:
-                    total_remaining += rp_rem
-                breakdown.append(
+                total_remaining += rp_rem
+                append(
                     {
                         "id": v.id,
                         "name": v.name,
                         "rank": v.rank_id,
                         "rp_cost": rp_total,
-                        "rp_current": int(rp_cur),
-                        "rp_remaining": int(rp_rem),
-                        "done": bool(done),
+                        "rp_current": rp_cur,
+                        "rp_remaining": rp_rem,
+                        "done": done,
                     }
                 )
 
@@ -706,11 +1192,11 @@ def create_app() -> Flask:
             battles = None
             minutes = None
         else:
-            battles = math.ceil(total_remaining / effective)
+            battles = int(-(-total_remaining // effective))
             minutes = int(round(battles * avg_min)) if battles is not None else None
 
         hours = None if minutes is None else round(minutes / 60.0, 2)
-        ge_cost_by_rate = int(math.ceil(total_remaining / 45.0)) if total_remaining > 0 else 0
+        ge_cost_by_rate = -(-total_remaining // 45) if total_remaining > 0 else 0
 
         return jsonify(
             {
@@ -734,8 +1220,19 @@ def create_app() -> Flask:
     # --- Importer JSON ---
     @app.post("/api/import")
     def import_api():
-        data = request.get_json(silent=True) or {}
+        # duże payloady importu parsujemy wprost z bajtów, z pominięciem
+        # narzutu request.get_json
+        raw = request.get_data()
+        try:
+            data = orjson.loads(raw) if raw else {}
+        except orjson.JSONDecodeError:
+            data = {}
+        from importer import import_from_json_dict
+
         rep = import_from_json_dict(data)
+        invalidate_dict_cache()
+        invalidate_name_index()
+        invalidate_vehicle_dicts()
         return jsonify(rep)
 
     # ---------- CLI ----------
@@ -753,22 +1250,24 @@ def create_app() -> Flask:
         if not user_path:
             user_path = click.prompt("Path to JSON", type=str)
 
-        candidates = []
-        candidates.append(os.path.abspath(os.path.normpath(os.path.expanduser(user_path))))
-        candidates.append(os.path.abspath(os.path.join(app.root_path, user_path)))
+        def candidates():
+            yield os.path.abspath(os.path.normpath(os.path.expanduser(user_path)))
+            yield os.path.abspath(os.path.join(app.root_path, user_path))
+            backend_prefix = "backend" + os.sep
+            if user_path.startswith(backend_prefix):
+                trimmed = user_path[len(backend_prefix) :]
+                yield os.path.abspath(os.path.join(app.root_path, trimmed))
 
-        backend_prefix = "backend" + os.sep
-        if user_path.startswith(backend_prefix):
-            trimmed = user_path[len(backend_prefix) :]
-            candidates.append(os.path.abspath(os.path.join(app.root_path, trimmed)))
-
-        final_path = next((p for p in candidates if os.path.exists(p)), None)
+        # pierwszy istniejący plik wygrywa — bez budowania wszystkich ścieżek
+        final_path = next((p for p in candidates() if os.path.isfile(p)), None)
         if not final_path:
             raise click.FileError(
                 user_path,
                 hint="File not found. Try a path relative to 'backend/', e.g., sample_data/us_tiny.json",
             )
 
+        from importer import import_from_json_file
+
         rep = import_from_json_file(final_path)
         print("Import done:", rep)
 
@@ -1,18 +1,18 @@
 from __future__ import annotations
 
-import math
+import functools
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
 
-from sqlalchemy import asc
+from sqlalchemy import asc, bindparam, select, text
 
-from models import Vehicle, VehicleEdge
+from models import db, Vehicle
 
 # Współczynnik konta premium (domyślnie +100% RP)
 PREMIUM_RP_MULT = 2.0
 
 
-@dataclass
+@dataclass(frozen=True)
 class ProfileParams:
     avg_rp_per_battle: int = 0
     avg_battle_minutes: int = 0
@@ -20,6 +20,33 @@ class ProfileParams:
     booster_percent: Optional[int] = None     # 50 -> +50%
     skill_bonus_percent: Optional[int] = None # 10 -> +10%
 
+    # parametry są niezmienne, więc mnożnik liczymy raz na instancję —
+    # batch estymat po całym drzewie nie powtarza tych samych gałęzi.
+    # Ułamek licznik/mianownik zamiast łańcucha mnożeń float: bonusy są
+    # procentowe, więc mnożnik jest wymierny i ceil-dzielenie bitew może
+    # zostać w dokładnej arytmetyce całkowitej.
+    @functools.cached_property
+    def mult_ratio(self) -> Tuple[int, int]:
+        # typowy przypadek darmowego konta: żadnych bonusów, mnożnik 1/1
+        if not (self.has_premium or self.booster_percent or self.skill_bonus_percent):
+            return 1, 1
+        num, denom = 1, 1
+        if self.has_premium:
+            num *= int(PREMIUM_RP_MULT * 100)
+            denom *= 100
+        if self.booster_percent:
+            num *= 100 + self.booster_percent
+            denom *= 100
+        if self.skill_bonus_percent:
+            num *= 100 + self.skill_bonus_percent
+            denom *= 100
+        return num, denom
+
+    @functools.cached_property
+    def mult(self) -> float:
+        num, denom = self.mult_ratio
+        return num / denom
+
     @classmethod
     def from_row(cls, row) -> "ProfileParams":
         if row is None:
@@ -46,14 +73,7 @@ class ProfileParams:
 
 def effective_rp_per_battle(p: ProfileParams) -> float:
     """Policzenie efektywnego RP/battle z mnożnikami premium/booster/skill."""
-    mult = 1.0
-    if p.has_premium:
-        mult *= PREMIUM_RP_MULT
-    if p.booster_percent:
-        mult *= (1.0 + (p.booster_percent / 100.0))
-    if p.skill_bonus_percent:
-        mult *= (1.0 + (p.skill_bonus_percent / 100.0))
-    return max(0.0, float(p.avg_rp_per_battle) * mult)
+    return max(0.0, float(p.avg_rp_per_battle) * p.mult)
 
 
 # ---------- Recent battles (5 ostatnich) ----------
@@ -73,31 +93,44 @@ def summarize_recent_battles(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
     Zwraca bazową średnią RP/bitwę (po zdjęciu bonusów) oraz średni czas.
     rows: [{rp, minutes, premium, booster_percent}]
     """
+    # gorąca pętla: builtiny i append jako lokalne nazwy (LOAD_FAST zamiast
+    # LOAD_GLOBAL per wiersz), a normalizacja bonusów inline — to kilka
+    # mnożeń, wywołanie funkcji kosztuje więcej niż sama arytmetyka
+    _float = float
+    _int = int
+    _bool = bool
     safe = []
+    append = safe.append
     for r in rows or []:
         try:
-            rp = float(r.get("rp") or 0)
-            minutes = float(r.get("minutes") or 0)
-            premium = bool(r.get("premium") or False)
+            rp = _float(r.get("rp") or 0)
+            minutes = _float(r.get("minutes") or 0)
+            premium = _bool(r.get("premium") or False)
             booster = r.get("booster_percent")
-            booster = int(booster) if booster not in (None, "") else None
-            safe.append((rp, minutes, premium, booster))
+            booster = _int(booster) if booster not in (None, "") else None
+            append((rp, minutes, premium, booster))
         except Exception:
             continue
 
     if not safe:
         return {"samples": 0, "avg_rp_per_battle": 0, "avg_battle_minutes": 0}
 
+    premium_mult = PREMIUM_RP_MULT
     base_sum = 0.0
-    min_vals: List[float] = []
+    min_sum = 0.0
+    min_cnt = 0
     for rp, minutes, premium, booster in safe:
-        base_sum += _normalize_base_rp(rp, premium, booster)
+        denom = premium_mult if premium else 1.0
+        if booster is not None:
+            denom *= 1.0 + booster / 100.0
+        base_sum += rp / denom if denom > 0 else rp
         if minutes > 0:
-            min_vals.append(minutes)
+            min_sum += minutes
+            min_cnt += 1
 
     samples = len(safe)
     avg_rp = base_sum / samples if samples else 0.0
-    avg_min = (sum(min_vals) / len(min_vals)) if min_vals else 0.0
+    avg_min = min_sum / min_cnt if min_cnt else 0.0
 
     return {
         "samples": samples,
@@ -107,42 +140,107 @@ def summarize_recent_battles(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
 
 
 # ---------- Warianty w folderach / wymagania ----------
-def list_variants_for_parent(parent_id: int) -> List[Vehicle]:
-    return (
-        Vehicle.query
-        .filter(Vehicle.folder_of == parent_id)
-        .order_by(asc(Vehicle.rank_id), asc(Vehicle.br_rb), asc(Vehicle.name))
-        .all()
-    )
+# Indeks folder_of -> posortowane [id] budowany jednym zapytaniem przy
+# pierwszym użyciu — przejście po drzewie nie powtarza tego samego
+# ORDER BY per folder. Unieważniany razem z generacją grafu po imporcie.
+_FOLDER_INDEX: Optional[Dict[int, List[int]]] = None
+
+
+def _folder_index() -> Dict[int, List[int]]:
+    global _FOLDER_INDEX
+    if _FOLDER_INDEX is None:
+        index: Dict[int, List[int]] = {}
+        rows = db.session.execute(
+            select(Vehicle.id, Vehicle.folder_of)
+            .where(Vehicle.folder_of.is_not(None))
+            .order_by(asc(Vehicle.rank_id), Vehicle.br_effective.asc(), asc(Vehicle.name))
+        )
+        for vid, parent_id in rows:
+            index.setdefault(parent_id, []).append(vid)
+        _FOLDER_INDEX = index
+    return _FOLDER_INDEX
+
+
+def list_variants_for_parent(parent_id: int) -> List[int]:
+    # wołający konsumują wyłącznie id — bez materializacji obiektów ORM
+    return list(_folder_index().get(parent_id, ()))
 
 def prev_variant_id_if_any(v: Vehicle) -> Optional[int]:
     if not getattr(v, "folder_of", None):
         return None
-    siblings = list_variants_for_parent(v.folder_of)
     prev = None
-    for s in siblings:
-        if s.id == v.id:
+    for sid in list_variants_for_parent(v.folder_of):
+        if sid == v.id:
             break
-        prev = s
-    return prev.id if prev else None
+        prev = sid
+    return prev
 
-def prerequisites_for(vehicle_id: int) -> List[int]:
-    v = Vehicle.query.get(vehicle_id)
-    if not v:
-        return []
+# Trzy źródła zależności (krawędzie, rodzic folderu, poprzedni wariant
+# w porządku folderu) jednym UNION-em — zamiast 3-5 osobnych rund do bazy
+# na każdą estymację.
+_PREREQ_IDS_SQL = text(
+    """
+    WITH variant_prev AS (
+        SELECT id,
+               LAG(id) OVER (
+                   PARTITION BY folder_of
+                   ORDER BY rank_id, br_effective, name
+               ) AS prev_id
+        FROM vehicles
+        WHERE folder_of IS NOT NULL
+    )
+    SELECT parent_id FROM vehicle_edges WHERE child_id = :vid
+    UNION
+    SELECT folder_of FROM vehicles WHERE id = :vid AND folder_of IS NOT NULL
+    UNION
+    SELECT prev_id FROM variant_prev WHERE id = :vid AND prev_id IS NOT NULL
+    """
+)
+
+# Graf zależności jest niezmienny między importami; wyniki per pojazd
+# memoizujemy z generacją grafu w kluczu — import podbija generację i stare
+# wpisy przestają być trafiane (LRU wypiera je naturalnie).
+_GRAPH_GEN = 0
+
+
+def bump_graph_generation() -> None:
+    """Unieważnia memoizację grafu — wołane po każdym imporcie danych."""
+    global _GRAPH_GEN, _FOLDER_INDEX
+    _GRAPH_GEN += 1
+    _FOLDER_INDEX = None
 
-    req_ids: set[int] = set()
 
-    for e in VehicleEdge.query.filter_by(child_id=vehicle_id).all():
-        req_ids.add(e.parent_id)
+@functools.lru_cache(maxsize=4096)
+def _prereqs_cached(vehicle_id: int, gen: int) -> Tuple[int, ...]:
+    return tuple(
+        row[0] for row in db.session.execute(_PREREQ_IDS_SQL, {"vid": vehicle_id})
+    )
+
+
+def prerequisites_for(vehicle_id: int) -> List[int]:
+    return list(_prereqs_cached(vehicle_id, _GRAPH_GEN))
 
-    if getattr(v, "folder_of", None):
-        req_ids.add(v.folder_of)
-        pv = prev_variant_id_if_any(v)
-        if pv:
-            req_ids.add(pv)
 
-    return list(req_ids)
+# Wariant zbiorczy tego samego UNION-a: pary (pojazd, wymaganie) dla całej
+# listy id naraz, z rozwijanym bindparamem zamiast zapytania per pojazd.
+_PREREQ_PAIRS_MANY_SQL = text(
+    """
+    WITH variant_prev AS (
+        SELECT id,
+               LAG(id) OVER (
+                   PARTITION BY folder_of
+                   ORDER BY rank_id, br_effective, name
+               ) AS prev_id
+        FROM vehicles
+        WHERE folder_of IS NOT NULL
+    )
+    SELECT child_id, parent_id FROM vehicle_edges WHERE child_id IN :ids
+    UNION
+    SELECT id, folder_of FROM vehicles WHERE id IN :ids AND folder_of IS NOT NULL
+    UNION
+    SELECT id, prev_id FROM variant_prev WHERE id IN :ids AND prev_id IS NOT NULL
+    """
+).bindparams(bindparam("ids", expanding=True))
 
 
 # ---------- Estymacje ----------
@@ -151,7 +249,7 @@ def estimate_to_unlock(vehicle_id: int, current_rp: int, profile: ProfileParams)
     Szacuje liczbę bitew i czas potrzebny do odblokowania pojazdu.
     Nie sprawdza, czy spełniono wymagania — to możesz odczytać przez prerequisites_for().
     """
-    v = Vehicle.query.get(vehicle_id)
+    v = db.session.get(Vehicle, vehicle_id)
     if not v or not v.rp_cost:
         return {
             "vehicle_id": vehicle_id,
@@ -161,12 +259,16 @@ def estimate_to_unlock(vehicle_id: int, current_rp: int, profile: ProfileParams)
     effective = effective_rp_per_battle(profile)
     remaining = max(0, int(v.rp_cost) - int(current_rp or 0))
 
+    # ceil(remaining / effective) w dokładnych liczbach całkowitych:
+    # effective = avg * num / denom, więc bitwy = ceil(remaining*denom / (avg*num))
+    num, denom = profile.mult_ratio
+    rp_num = int(profile.avg_rp_per_battle or 0) * num
     if remaining == 0:
         battles = 0
-    elif effective <= 0.0:
+    elif rp_num <= 0:
         battles = None
     else:
-        battles = math.ceil(remaining / effective)
+        battles = (remaining * denom + rp_num - 1) // rp_num
 
     minutes = None if battles is None else (battles * int(profile.avg_battle_minutes or 0))
     hours = None if minutes is None else round(minutes / 60.0, 2)
@@ -188,6 +290,74 @@ def estimate_to_unlock(vehicle_id: int, current_rp: int, profile: ProfileParams)
         "prerequisite_ids": prerequisites_for(vehicle_id),
     }
 
+def estimate_to_unlock_many(
+    vehicle_ids: List[int],
+    current_rp_map: Dict[int, int],
+    profile: ProfileParams,
+) -> List[Dict[str, Any]]:
+    """
+    Zbiorczy odpowiednik estimate_to_unlock: dwa zapytania (pojazdy +
+    pary zależności) na całą listę id zamiast 3-5 rund na pojazd.
+    Zwraca listę wyników w kolejności vehicle_ids, w tym samym kształcie
+    co estimate_to_unlock.
+    """
+    ids = [int(i) for i in vehicle_ids]
+    if not ids:
+        return []
+
+    vehicles = {
+        v.id: v for v in db.session.scalars(select(Vehicle).where(Vehicle.id.in_(ids)))
+    }
+    prereqs: Dict[int, List[int]] = {i: [] for i in ids}
+    for child_id, parent_id in db.session.execute(_PREREQ_PAIRS_MANY_SQL, {"ids": ids}):
+        prereqs[child_id].append(parent_id)
+
+    effective = effective_rp_per_battle(profile)
+    avg_minutes = int(profile.avg_battle_minutes or 0)
+    num, denom = profile.mult_ratio
+    rp_num = int(profile.avg_rp_per_battle or 0) * num
+
+    results: List[Dict[str, Any]] = []
+    for vid in ids:
+        v = vehicles.get(vid)
+        if not v or not v.rp_cost:
+            results.append(
+                {"vehicle_id": vid, "error": "Vehicle not found or rp_cost missing"}
+            )
+            continue
+
+        remaining = max(0, int(v.rp_cost) - int(current_rp_map.get(vid) or 0))
+        if remaining == 0:
+            battles = 0
+        elif rp_num <= 0:
+            battles = None
+        else:
+            battles = (remaining * denom + rp_num - 1) // rp_num
+
+        minutes = None if battles is None else (battles * avg_minutes)
+        hours = None if minutes is None else round(minutes / 60.0, 2)
+
+        results.append(
+            {
+                "vehicle": {
+                    "id": v.id,
+                    "name": v.name,
+                    "rank": v.rank_id,
+                    "type": v.type_str,
+                    "rp_cost": v.rp_cost,
+                },
+                "rp_current": int(current_rp_map.get(vid) or 0),
+                "rp_remaining": remaining,
+                "effective_rp_per_battle": effective,
+                "battles_needed": battles,
+                "minutes_needed": minutes,
+                "hours_needed": hours,
+                "prerequisite_ids": prereqs[vid],
+            }
+        )
+    return results
+
+
 def estimate(
     vehicle_id: int,
     current_rp: int,
@@ -1,8 +1,39 @@
-import json
-from typing import Any, Dict, List, Tuple
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Tuple
 
+import ijson
+from sqlalchemy import bindparam, insert, select, text, update
+
+import calc
 from models import db, Nation, VehicleClass, Rank, Vehicle, VehicleEdge
 
+
+@contextmanager
+def _indexes_dropped():
+    """Zdejmij zwykłe (nieunikalne) indeksy na czas masowego importu.
+
+    Każdy insert płaci log-N za każdy żywy indeks; taniej jest wstawić
+    wszystko i odbudować indeksy raz, po imporcie.
+    """
+    bind = db.session.get_bind()
+    indexes = [
+        ix
+        for table in (Vehicle.__table__, VehicleEdge.__table__)
+        for ix in table.indexes
+        if not ix.unique
+    ]
+    for ix in indexes:
+        ix.drop(bind=bind, checkfirst=True)
+    try:
+        yield
+    finally:
+        for ix in indexes:
+            ix.create(bind=bind, checkfirst=True)
+
+# współdzielony pusty dict zamiast literału `or {}` w gorącej pętli —
+# bez trzech jednorazowych alokacji na każdy pojazd (nigdy nie mutowany)
+_EMPTY: Dict[str, Any] = {}
+
 def _to_int(x, default=None):
     try:
         return int(x)
@@ -15,55 +46,98 @@ def _to_float(x, default=None):
     except Exception:
         return default
 
-def _get_or_create(model, **kwargs):
-    inst = model.query.filter_by(**kwargs).first()
-    if inst:
-        return inst, False
-    inst = model(**kwargs)
-    db.session.add(inst)
-    return inst, True
+def _new_report() -> Dict[str, Any]:
+    return {"nations": 0, "classes": 0, "ranks": 0, "vehicles": 0, "edges": 0, "warnings": []}
 
-def _import_from_data(data: Dict[str, Any]) -> Dict[str, Any]:
-    report: Dict[str, Any] = {"nations": 0, "classes": 0, "ranks": 0, "vehicles": 0, "edges": 0, "warnings": []}
+def _import_dictionaries(
+    report: Dict[str, Any],
+    nations: Iterable[Dict[str, Any]],
+    classes: Iterable[Any],
+    ranks: Iterable[Dict[str, Any]],
+) -> Tuple[Dict[str, int], Dict[str, int], Dict[int, Rank]]:
+    """Etap słowników: nations/classes/ranks. Zwraca mapy slug/nazwa -> id."""
+    # słowniki ładujemy raz i mutujemy w pamięci — bez SELECT-u
+    # filter_by().first() na każdy wpis nations/classes/ranks
+    nation_by_slug = {n.slug: n for n in Nation.query.all()}
+    class_by_name = {c.name: c for c in VehicleClass.query.all()}
+    rank_by_id = {r.id: r for r in Rank.query.all()}
 
     # --- nations ---
-    for nd in data.get("nations", []):
+    for nd in nations:
         if not isinstance(nd, dict):
             report["warnings"].append(f"Unexpected nation entry: {nd!r}")
             continue
         slug = nd["slug"]
-        n, _ = _get_or_create(Nation, slug=slug)
+        n = nation_by_slug.get(slug)
+        if n is None:
+            n = Nation(slug=slug)
+            db.session.add(n)
+            nation_by_slug[slug] = n
         n.name = nd.get("name", slug)
         n.flag_url = nd.get("flag_url")
         report["nations"] += 1
 
     # --- classes ---
-    for cn in data.get("classes", []):
+    for cn in classes:
         name = cn["name"] if isinstance(cn, dict) else str(cn)
-        _get_or_create(VehicleClass, name=name)
+        if name not in class_by_name:
+            c = VehicleClass(name=name)
+            db.session.add(c)
+            class_by_name[name] = c
         report["classes"] += 1
 
     # --- ranks ---
-    for rr in data.get("ranks", []):
+    for rr in ranks:
         rid = _to_int(rr.get("id"), None)
         if rid is None:
             report["warnings"].append(f"Bad rank entry: {rr!r}")
             continue
-        r, _ = _get_or_create(Rank, id=rid)
+        r = rank_by_id.get(rid)
+        if r is None:
+            r = Rank(id=rid)
+            db.session.add(r)
+            rank_by_id[rid] = r
         r.label = str(rr.get("label") or rid)
         report["ranks"] += 1
 
     db.session.flush()
 
-    slug_to_id = {n.slug: n.id for n in Nation.query.all()}
-    class_to_id = {c.name: c.id for c in VehicleClass.query.all()}
+    slug_to_id = {slug: n.id for slug, n in nation_by_slug.items()}
+    class_to_id = {name: c.id for name, c in class_by_name.items()}
+    return slug_to_id, class_to_id, rank_by_id
+
+# przy strumieniowym imporcie nie trzymamy całej listy pojazdów w pamięci —
+# wiersze idą do bazy partiami tej wielkości
+_VEHICLE_BATCH = 1000
 
+def _import_vehicles(
+    report: Dict[str, Any],
+    vehicles: Iterable[Dict[str, Any]],
+    slug_to_id: Dict[str, int],
+    class_to_id: Dict[str, int],
+    rank_by_id: Dict[int, Rank],
+) -> Tuple[Dict[str, int], List[Tuple[str, str]], List[Tuple[str, str, int | None]]]:
+    """Etap pojazdów: przyjmuje dowolną iterowalną sekwencję (lista lub strumień)."""
     key_to_id: Dict[str, int] = {}
     folders: List[Tuple[str, str]] = []
     per_vehicle_edges: List[Tuple[str, str, int | None]] = []
+    vehicle_keys: List[str] = []
+    vehicle_rows: List[Dict[str, Any]] = []
+
+    def _flush_batch():
+        # jeden zbiorczy INSERT..RETURNING zamiast add()+flush() per pojazd;
+        # sort_by_parameter_order gwarantuje, że id wracają w kolejności wierszy
+        returned_ids = db.session.scalars(
+            insert(Vehicle).returning(Vehicle.id, sort_by_parameter_order=True),
+            vehicle_rows,
+        )
+        for key, vid in zip(vehicle_keys, returned_ids):
+            key_to_id[key] = vid
+        vehicle_keys.clear()
+        vehicle_rows.clear()
 
     # --- vehicles ---
-    for vd in data.get("vehicles", []):
+    for vd in vehicles:
         key = vd.get("key") or vd.get("id") or vd.get("name")
 
         n_slug = vd["nation"]
@@ -76,40 +150,43 @@ def _import_from_data(data: Dict[str, Any]) -> Dict[str, Any]:
         if c_name not in class_to_id:
             report["warnings"].append(f"Unknown class '{c_name}' for vehicle {key}")
             continue
-        if db.session.get(Rank, rank_id) is None:
+        if rank_id not in rank_by_id:
             report["warnings"].append(f"Unknown rank '{rank_id}' for vehicle {key}")
             continue
 
         vtype = vd.get("type", "tree")
-        is_tree = (vtype == "tree")
-        is_premium = (vtype == "premium")
-        is_collector = (vtype == "collector")
-
-        v = Vehicle(
-            name=vd["name"],
-            nation_id=slug_to_id[n_slug],
-            class_id=class_to_id[c_name],
-            rank_id=rank_id,
-            is_tree=is_tree,
-            is_premium=is_premium,
-            is_collector=is_collector,
-            rp_cost=_to_int(vd.get("rp_cost")),
-            ge_cost=_to_int(vd.get("ge_cost")),
-            gjn_cost=_to_int(vd.get("gjn_cost")),
-            br_ab=_to_float(vd.get("br_ab")) or _to_float((vd.get("br") or {}).get("ab")),
-            br_rb=_to_float(vd.get("br_rb")) or _to_float((vd.get("br") or {}).get("rb")),
-            br_sb=_to_float(vd.get("br_sb")) or _to_float((vd.get("br") or {}).get("sb")),
-            image_url=vd.get("image_url"),
-            wiki_url=vd.get("wiki_url"),
-        )
+        if vtype == "premium":
+            kind = Vehicle.KIND_PREMIUM
+        elif vtype == "collector":
+            kind = Vehicle.KIND_COLLECTOR
+        else:
+            kind = Vehicle.KIND_TREE
 
-        db.session.add(v)
-        db.session.flush()
-        key_to_id[key] = v.id
+        br = vd.get("br") or _EMPTY
+
+        vehicle_keys.append(key)
+        vehicle_rows.append(
+            {
+                "name": vd["name"],
+                "nation_id": slug_to_id[n_slug],
+                "class_id": class_to_id[c_name],
+                "rank_id": rank_id,
+                "kind": kind,
+                "rp_cost": _to_int(vd.get("rp_cost")),
+                "ge_cost": _to_int(vd.get("ge_cost")),
+                "gjn_cost": _to_int(vd.get("gjn_cost")),
+                "br_ab": _to_float(vd.get("br_ab")) or _to_float(br.get("ab")),
+                "br_rb": _to_float(vd.get("br_rb")) or _to_float(br.get("rb")),
+                "br_sb": _to_float(vd.get("br_sb")) or _to_float(br.get("sb")),
+                "image_url": vd.get("image_url"),
+                "wiki_url": vd.get("wiki_url"),
+                "folder_of": None,
+            }
+        )
         report["vehicles"] += 1
 
         # edges osadzone w pojeździe
-        ed = vd.get("edges") or {}
+        ed = vd.get("edges") or _EMPTY
         parents = ed.get("parents") or []
         urp = _to_int(ed.get("unlock_rp"))
         if isinstance(parents, list):
@@ -121,45 +198,170 @@ def _import_from_data(data: Dict[str, Any]) -> Dict[str, Any]:
         if folder_key:
             folders.append((key, folder_key))
 
+        if len(vehicle_rows) >= _VEHICLE_BATCH:
+            _flush_batch()
+
+    if vehicle_rows:
+        _flush_batch()
+    return key_to_id, folders, per_vehicle_edges
+
+def _import_links(
+    report: Dict[str, Any],
+    key_to_id: Dict[str, int],
+    folders: List[Tuple[str, str]],
+    per_vehicle_edges: List[Tuple[str, str, int | None]],
+    edges: Iterable[Dict[str, Any]],
+) -> None:
+    """Etap powiązań: folder_of i krawędzie drzewka."""
     # --- folder_of ---
+    folder_updates: List[Dict[str, int]] = []
     for variant_key, parent_key in folders:
         v_id = key_to_id.get(variant_key)
         p_id = key_to_id.get(parent_key)
         if v_id and p_id:
-            v = db.session.get(Vehicle, v_id)
-            v.folder_of = p_id
+            folder_updates.append({"b_id": v_id, "b_folder": p_id})
         else:
             report["warnings"].append(f"Folder link unresolved: {variant_key} -> {parent_key}")
+    if folder_updates:
+        # executemany na poziomie Core — sesja ORM nie ma tu czego synchronizować
+        db.session.connection().execute(
+            update(Vehicle.__table__)
+            .where(Vehicle.__table__.c.id == bindparam("b_id"))
+            .values(folder_of=bindparam("b_folder")),
+            folder_updates,
+        )
 
     # --- edges ---
-    created_edges = 0
+    # istniejące pary (parent, child) ściągamy raz — deduplikacja w pamięci
+    # zamiast SELECT-u na każdą krawędź, insert jednym executemany na końcu
+    existing_edges: set[Tuple[int, int]] = set(
+        db.session.execute(select(VehicleEdge.parent_id, VehicleEdge.child_id))
+    )
+    edge_rows: List[Dict[str, Any]] = []
 
     def _create_edge(pkey: str, ckey: str, urp_val: int | None):
-        nonlocal created_edges
         p = key_to_id.get(pkey)
         c = key_to_id.get(ckey)
         if not p or not c:
             report["warnings"].append(f"Edge unresolved: {pkey} -> {ckey}")
             return
-        if VehicleEdge.query.filter_by(parent_id=p, child_id=c).first():
+        if (p, c) in existing_edges:
             return
-        db.session.add(VehicleEdge(parent_id=p, child_id=c, unlock_rp=urp_val))
-        created_edges += 1
+        existing_edges.add((p, c))
+        edge_rows.append({"parent_id": p, "child_id": c, "unlock_rp": urp_val})
 
     for pk, ck, urp in per_vehicle_edges:
         _create_edge(pk, ck, urp)
 
-    for ed in data.get("edges", []):
+    for ed in edges:
         _create_edge(ed.get("parent_key"), ed.get("child_key"), _to_int(ed.get("unlock_rp")))
 
-    report["edges"] = created_edges
+    if edge_rows:
+        db.session.execute(insert(VehicleEdge), edge_rows)
+
+    report["edges"] = len(edge_rows)
+
+# Pełna przebudowa domknięcia przechodniego grafu zależności jednym
+# INSERT..SELECT — te same trzy źródła par co w calc, potem rekurencja.
+# Hooki after_insert na krawędziach by tu nie zadziałały: import wstawia
+# krawędzie zbiorczo przez Core, z pominięciem zdarzeń ORM.
+_REBUILD_CLOSURE_SQL = text(
+    """
+    INSERT INTO vehicle_closure (descendant_id, ancestor_id, depth)
+    WITH RECURSIVE variant_prev AS (
+        SELECT id,
+               LAG(id) OVER (
+                   PARTITION BY folder_of
+                   ORDER BY rank_id, br_effective, name
+               ) AS prev_id
+        FROM vehicles
+        WHERE folder_of IS NOT NULL
+    ),
+    pairs(child_id, parent_id) AS (
+        SELECT child_id, parent_id FROM vehicle_edges
+        UNION
+        SELECT id, folder_of FROM vehicles WHERE folder_of IS NOT NULL
+        UNION
+        SELECT id, prev_id FROM variant_prev WHERE prev_id IS NOT NULL
+    ),
+    closure(descendant_id, ancestor_id, depth) AS (
+        SELECT child_id, parent_id, 1 FROM pairs
+        UNION
+        SELECT c.descendant_id, p.parent_id, c.depth + 1
+        FROM closure c JOIN pairs p ON p.child_id = c.ancestor_id
+        -- twardy limit głębokości: przy cyklu w danych depth+1 czyniłby
+        -- każdą odwiedzoną parę „nową" i rekurencja nigdy by nie stanęła;
+        -- 64 przekracza każdą realną gałąź drzewka o rząd wielkości
+        WHERE c.depth < 64
+    )
+    SELECT descendant_id, ancestor_id, MIN(depth)
+    FROM closure
+    GROUP BY descendant_id, ancestor_id
+    """
+)
+
+def _rebuild_closure() -> None:
+    db.session.execute(text("DELETE FROM vehicle_closure"))
+    db.session.execute(_REBUILD_CLOSURE_SQL)
+
+# Po przebudowie domknięcia: suma RP od początku drzewka per pojazd jednym
+# UPDATE-em — zapytania o łączny koszt nie agregują niczego w locie.
+_RECOMPUTE_CUM_RP_SQL = text(
+    """
+    UPDATE vehicles SET cum_rp_to_unlock =
+        COALESCE(rp_cost, 0) + COALESCE((
+            SELECT SUM(COALESCE(a.rp_cost, 0))
+            FROM vehicle_closure c JOIN vehicles a ON a.id = c.ancestor_id
+            WHERE c.descendant_id = vehicles.id
+        ), 0)
+    """
+)
+
+def _finish(report: Dict[str, Any]) -> Dict[str, Any]:
+    _rebuild_closure()
+    db.session.execute(_RECOMPUTE_CUM_RP_SQL)
     db.session.commit()
+    # graf się zmienił — unieważnij memoizację zależności w calc
+    calc.bump_graph_generation()
     return report
 
+def _import_from_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    report = _new_report()
+    slug_to_id, class_to_id, rank_by_id = _import_dictionaries(
+        report, data.get("nations", []), data.get("classes", []), data.get("ranks", [])
+    )
+    key_to_id, folders, per_vehicle_edges = _import_vehicles(
+        report, data.get("vehicles", []), slug_to_id, class_to_id, rank_by_id
+    )
+    _import_links(report, key_to_id, folders, per_vehicle_edges, data.get("edges", []))
+    return _finish(report)
+
 def import_from_json_dict(data: Dict[str, Any]) -> Dict[str, Any]:
-    return _import_from_data(data)
+    with _indexes_dropped():
+        return _import_from_data(data)
 
 def import_from_json_file(path: str) -> Dict[str, Any]:
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return _import_from_data(data)
+    # strumieniowo przez ijson: pojazdy (największa sekcja) przetwarzamy
+    # rekord po rekordzie zamiast materializować cały plik jako dict —
+    # szczyt pamięci to partia _VEHICLE_BATCH wierszy, nie całe drzewko.
+    # Małe sekcje czytamy osobnymi przebiegami po pliku (seek jest tani).
+    with _indexes_dropped():
+        with open(path, "rb") as f:
+            report = _new_report()
+            nations = list(ijson.items(f, "nations.item"))
+            f.seek(0)
+            classes = list(ijson.items(f, "classes.item"))
+            f.seek(0)
+            ranks = list(ijson.items(f, "ranks.item"))
+            f.seek(0)
+            slug_to_id, class_to_id, rank_by_id = _import_dictionaries(
+                report, nations, classes, ranks
+            )
+            key_to_id, folders, per_vehicle_edges = _import_vehicles(
+                report, ijson.items(f, "vehicles.item"), slug_to_id, class_to_id, rank_by_id
+            )
+            f.seek(0)
+            _import_links(
+                report, key_to_id, folders, per_vehicle_edges, ijson.items(f, "edges.item")
+            )
+            return _finish(report)
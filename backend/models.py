@@ -1,12 +1,54 @@
+from contextlib import contextmanager
 from datetime import datetime
+from enum import IntEnum
+from typing import Iterator, List
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
+from sqlalchemy import (
+    CheckConstraint,
+    Computed,
+    event,
+    DateTime,
+    ForeignKey,
+    Index,
+    SmallInteger,
+    String,
+    UniqueConstraint,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 db = SQLAlchemy()
 
 
+@contextmanager
+def count_queries(engine=None) -> Iterator[List[str]]:
+    """Zbiera SQL-e wykonane w bloku — strażnik regresji N+1.
+
+    Trasy celowo trzymają stałą, małą liczbę zapytań (projekcje, domknięcie,
+    cache słowników); test może to wymusić:
+
+        with count_queries() as statements:
+            client.get("/api/vehicles")
+        assert len(statements) <= 3
+    """
+    target = engine if engine is not None else db.engine
+    statements: List[str] = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(target, "before_cursor_execute", _record)
+    try:
+        yield statements
+    finally:
+        event.remove(target, "before_cursor_execute", _record)
+
+
 # ── Słowniki ────────────────────────────────────────────────────────────────────
 class Nation(db.Model):
     __tablename__ = "nations"
@@ -43,61 +85,102 @@ class Rank(db.Model):
 # ── Pojazd ──────────────────────────────────────────────────────────────────────
 class Vehicle(db.Model):
     __tablename__ = "vehicles"
+    __table_args__ = (
+        # złożony indeks pod filtry /api/vehicles (nation+class+rank+typ) —
+        # widok drzewka filtruje wszystkimi czterema naraz, planner nie musi
+        # dokładać re-filtrowania po jednokolumnowym indeksie
+        Index("ix_vehicles_nation_class_rank_tree", "nation_id", "class_id", "rank_id", "kind"),
+        # jeden wąski indeks po kind zastępuje trzy częściowe po flagach
+        Index("ix_vehicles_kind", "kind"),
+        CheckConstraint("kind IN (0, 1, 2)", name="ck_vehicles_kind"),
+        # indeks pokrywający porządek sortowania list — planner może zwracać
+        # wiersze już posortowane, bez osobnego kroku sortowania
+        Index("ix_vehicles_rank_id_id", "rank_id", "id"),
+        # filtry zakresowe br_min/br_max i porządek rank+BR schodzą na indeksy
+        # po zmaterializowanej kolumnie generowanej
+        Index("ix_vehicles_br_effective", "br_effective"),
+        Index("ix_vehicles_rank_br_effective", "rank_id", "br_effective"),
+        Index("ix_vehicles_class_br_effective", "class_id", "br_effective"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(nullable=False, index=True)
 
-    nation_id: Mapped[int] = mapped_column(ForeignKey("nations.id"), nullable=False, index=True)
+    # bez osobnego indeksu — nation_id prowadzi indeks złożony powyżej
+    nation_id: Mapped[int] = mapped_column(ForeignKey("nations.id"), nullable=False)
     class_id: Mapped[int] = mapped_column(ForeignKey("vehicle_classes.id"), nullable=False, index=True)
     rank_id: Mapped[int] = mapped_column(ForeignKey("ranks.id"), nullable=False, index=True)
 
-    # typy: drzewkowy/premium/kolekcjonerski (dokładnie jeden)
-    is_tree: Mapped[bool] = mapped_column(default=True, nullable=False)
-    is_premium: Mapped[bool] = mapped_column(default=False, nullable=False)
-    is_collector: Mapped[bool] = mapped_column(default=False, nullable=False)
+    # typ pojazdu jako jedna wąska kolumna zamiast trzech booli —
+    # dokładnie jeden z drzewkowy/premium/kolekcjonerski, węższy wiersz
+    # i jeden predykat w filtrach
+    KIND_TREE = 0
+    KIND_PREMIUM = 1
+    KIND_COLLECTOR = 2
+
+    kind: Mapped[int] = mapped_column(SmallInteger, default=KIND_TREE, nullable=False)
 
     # BR i koszty
     br_ab: Mapped[float | None] = mapped_column(nullable=True)
     br_rb: Mapped[float | None] = mapped_column(nullable=True)
     br_sb: Mapped[float | None] = mapped_column(nullable=True)
+    # efektywny BR (RB > AB > SB) liczony i przechowywany przez bazę —
+    # filtry/sortowanie nie przeliczają COALESCE per wiersz i mogą użyć indeksu
+    br_effective: Mapped[float | None] = mapped_column(
+        Computed("COALESCE(br_rb, br_ab, br_sb)", persisted=True), nullable=True
+    )
 
     rp_cost: Mapped[int | None] = mapped_column(nullable=True)
+    # zmaterializowana suma RP „od zera": własny rp_cost + koszty wszystkich
+    # przodków z vehicle_closure; przeliczana przy imporcie (graf i koszty
+    # zmieniają się tylko wtedy), odczyt to zwykła kolumna wiersza
+    cum_rp_to_unlock: Mapped[int | None] = mapped_column(nullable=True)
     ge_cost: Mapped[int | None] = mapped_column(nullable=True)       # Golden Eagles (premium)
     gjn_cost: Mapped[int | None] = mapped_column(nullable=True)      # Gaijin Coin (kolekcjonerskie)
 
-    image_url: Mapped[str | None] = mapped_column(nullable=True)
-    wiki_url: Mapped[str | None] = mapped_column(nullable=True)
+    # media są potrzebne tylko w serializacji list (projekcje Core wskazują
+    # je jawnie) — ładowanie obiektów ORM (kaskada, estymacje) ich nie
+    # dociąga, wiersz na gorącej ścieżce jest węższy
+    image_url: Mapped[str | None] = mapped_column(
+        nullable=True, deferred=True, deferred_group="media"
+    )
+    wiki_url: Mapped[str | None] = mapped_column(
+        nullable=True, deferred=True, deferred_group="media"
+    )
 
     # wariant „w folderze” -> id pojazdu-rodzica
     folder_of: Mapped[int | None] = mapped_column(ForeignKey("vehicles.id"), nullable=True, index=True)
 
-    nation = relationship("Nation")
-    vclass = relationship("VehicleClass")
-    rank = relationship("Rank")
-    folder_parent = relationship("Vehicle", remote_side=[id], uselist=False)
+    # relacje służą wyłącznie jako ścieżki JOIN-ów — serializacja idzie
+    # projekcjami Core, więc leniwe doładowanie to zawsze błąd (N+1);
+    # lazy="raise" zamienia taki przypadek w głośny wyjątek
+    nation = relationship("Nation", lazy="raise")
+    vclass = relationship("VehicleClass", lazy="raise")
+    rank = relationship("Rank", lazy="raise")
+    folder_parent = relationship("Vehicle", remote_side=[id], uselist=False, lazy="raise")
 
     # Wygodny string typu pojazdu do API/serializacji
     @property
     def type_str(self) -> str:
-        if self.is_premium:
+        if self.kind == self.KIND_PREMIUM:
             return "premium"
-        if self.is_collector:
+        if self.kind == self.KIND_COLLECTOR:
             return "collector"
         return "tree"
 
-    # „Miękka” normalizacja: jeśli któryś z typów ustawiony na True,
-    # wyłącz pozostałe – utrzymujemy wyłączność flag.
-    @validates("is_tree", "is_premium", "is_collector")
-    def _validate_type_flags(self, key: str, value: bool) -> bool:
-        v = bool(value)
-        if v:
-            if key != "is_tree" and getattr(self, "is_tree", False):
-                self.is_tree = False
-            if key != "is_premium" and getattr(self, "is_premium", False):
-                self.is_premium = False
-            if key != "is_collector" and getattr(self, "is_collector", False):
-                self.is_collector = False
-        return v
+    # hybrydy zachowują dotychczasowe API flag — w zapytaniach kompilują
+    # się do pojedynczego predykatu kind = N
+    @hybrid_property
+    def is_tree(self) -> bool:
+        return self.kind == self.KIND_TREE
+
+    @hybrid_property
+    def is_premium(self) -> bool:
+        return self.kind == self.KIND_PREMIUM
+
+    @hybrid_property
+    def is_collector(self) -> bool:
+        return self.kind == self.KIND_COLLECTOR
 
     def __repr__(self) -> str:
         return f"<Vehicle {self.id}:{self.name} ({self.type_str})>"
@@ -106,32 +189,69 @@ class Vehicle(db.Model):
 # ── Relacje drzewka: poprzednik -> następca ─────────────────────────────────────
 class VehicleEdge(db.Model):
     __tablename__ = "vehicle_edges"
-    __table_args__ = (UniqueConstraint("parent_id", "child_id", name="uq_edge_parent_child"),)
+    __table_args__ = (
+        UniqueConstraint("parent_id", "child_id", name="uq_edge_parent_child"),
+        # indeksy pokrywające oba kierunki trawersu drzewka (SQLite nie ma
+        # INCLUDE, więc unlock_rp jest zwykłą kolumną indeksu) — odczyt
+        # krawędzi nie schodzi do tabeli
+        Index("ix_edges_parent_covering", "parent_id", "child_id", "unlock_rp"),
+        Index("ix_edges_child_covering", "child_id", "parent_id", "unlock_rp"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    parent_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), nullable=False, index=True)
-    child_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), nullable=False, index=True)
+    # bez indeksów jednokolumnowych — pokrywają je indeksy złożone powyżej
+    parent_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), nullable=False)
+    child_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), nullable=False)
 
     # jeśli koszt RP odblokowania różni się od rp_cost dziecka (opcjonalnie)
     unlock_rp: Mapped[int | None] = mapped_column(nullable=True)
 
-    parent = relationship("Vehicle", foreign_keys=[parent_id])
-    child = relationship("Vehicle", foreign_keys=[child_id])
+    # krawędzie nigdy nie są mutowane przez te relacje — viewonly zdejmuje
+    # z unit-of-work śledzenie kaskad przy flushu
+    parent = relationship("Vehicle", foreign_keys=[parent_id], lazy="raise", viewonly=True)
+    child = relationship("Vehicle", foreign_keys=[child_id], lazy="raise", viewonly=True)
 
     def __repr__(self) -> str:
         return f"<Edge {self.parent_id}->{self.child_id}>"
 
 
+# ── Domknięcie przechodnie drzewka ──────────────────────────────────────────────
+class VehicleClosure(db.Model):
+    """Para (potomek, przodek) dla każdej pośredniej zależności w grafie.
+
+    Obejmuje wszystkie trzy źródła (krawędzie, rodzic folderu, poprzedni
+    wariant) i jest przebudowywana w całości przy imporcie — „wszystkie
+    wymagane rekurencyjnie" to wtedy pojedynczy SELECT po kluczu głównym
+    zamiast rekurencyjnego CTE na każde zapytanie o koszt RP.
+    """
+    __tablename__ = "vehicle_closure"
+
+    descendant_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), primary_key=True)
+    ancestor_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), primary_key=True)
+    # najkrótsza droga potomek -> przodek (1 = zależność bezpośrednia)
+    depth: Mapped[int] = mapped_column(SmallInteger, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<Closure {self.descendant_id}->{self.ancestor_id} d={self.depth}>"
+
+
 # ── Użytkownik i progres ────────────────────────────────────────────────────────
 class User(db.Model):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    email: Mapped[str] = mapped_column(unique=True, nullable=False, index=True)
-    password_hash: Mapped[str] = mapped_column(nullable=False)
-    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
-
-    profile = relationship("UserProfile", back_populates="user", uselist=False)
+    # jawne szerokości zamiast nieograniczonego TEXT: 254 to limit RFC dla
+    # adresu, 255 mieści hash argon2id (~97 znaków) i starsze hashe
+    # Werkzeug z okresu migracji
+    email: Mapped[str] = mapped_column(String(254), unique=True, nullable=False, index=True)
+    password_hash: Mapped[str] = mapped_column(String(255), nullable=False)
+    # znacznik wypełnia baza (server_default) — INSERT nie niesie parametru
+    # i nie woła przestarzałego datetime.utcnow po stronie Pythona
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    profile = relationship("UserProfile", back_populates="user", uselist=False, lazy="raise")
 
     def __repr__(self) -> str:
         return f"<User {self.email}>"
@@ -147,21 +267,70 @@ class UserProfile(db.Model):
     booster_percent: Mapped[int | None] = mapped_column(nullable=True)       # np. 50 = +50%
     skill_bonus_percent: Mapped[int | None] = mapped_column(nullable=True)   # np. 10 = +10%
 
-    user = relationship("User", back_populates="profile")
+    user = relationship("User", back_populates="profile", lazy="raise")
+
+
+class ProgressStatus(IntEnum):
+    """Status badań pojazdu — w bazie jako SMALLINT (porównania na int,
+    węższe wiersze i indeksy niż przy wolnym VARCHAR-ze)."""
+    LOCKED = 0
+    RESEARCHING = 1
+    UNLOCKED = 2
+    PURCHASED = 3
 
 
 class UserVehicleProgress(db.Model):
     __tablename__ = "user_vehicle_progress"
-    __table_args__ = (UniqueConstraint("user_id", "vehicle_id", name="uq_user_vehicle"),)
-
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
-    vehicle_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), nullable=False, index=True)
+    __table_args__ = (
+        # częsty odczyt „co właśnie badam" schodzi na mały indeks częściowy
+        Index(
+            "ix_progress_researching",
+            "user_id",
+            sqlite_where=text("status = 1"),
+        ),
+    )
+
+    # naturalny klucz złożony zamiast sztucznego id: user_id prowadzi
+    # (dominujący wzorzec dostępu to „cały mój progres"), unikalność pary
+    # wynika z klucza — bez osobnego ograniczenia i drugiego B-drzewa
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    vehicle_id: Mapped[int] = mapped_column(ForeignKey("vehicles.id"), primary_key=True, index=True)
 
-    # locked | researching | unlocked | purchased
-    status: Mapped[str] = mapped_column(default="locked", nullable=False)
+    status: Mapped[int] = mapped_column(
+        SmallInteger, default=ProgressStatus.LOCKED, nullable=False
+    )
     rp_earned: Mapped[int] = mapped_column(default=0, nullable=False)
-    last_seen_at: Mapped[datetime | None] = mapped_column(nullable=True)
-
-    user = relationship("User")
-    vehicle = relationship("Vehicle")
+    last_seen_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    user = relationship("User", lazy="raise")
+    vehicle = relationship("Vehicle", lazy="raise")
+
+    @classmethod
+    def upsert(cls, session, user_id: int, vehicle_id: int, **fields) -> "UserVehicleProgress":
+        """Zapis progresu jednym atomowym INSERT..ON CONFLICT DO UPDATE.
+
+        Zamiast pary SELECT + INSERT/UPDATE (dwie rundy i okno wyścigu na
+        kluczu) baza rozstrzyga konflikt sama; RETURNING oddaje aktualny
+        wiersz w tej samej rundzie.
+        """
+        # konstrukt INSERT dobieramy do dialektu — aplikacja wspiera też
+        # postgresowy DATABASE_URL (osobna gałąź opcji silnika w create_app)
+        dialect = session.get_bind().dialect.name
+        if dialect == "sqlite":
+            insert_fn = sqlite_insert
+        elif dialect == "postgresql":
+            insert_fn = pg_insert
+        else:
+            raise NotImplementedError(f"upsert: unsupported dialect {dialect!r}")
+        stmt = (
+            insert_fn(cls)
+            .values(user_id=user_id, vehicle_id=vehicle_id, **fields)
+            .on_conflict_do_update(
+                index_elements=["user_id", "vehicle_id"],
+                set_=fields if fields else {"vehicle_id": vehicle_id},
+            )
+            .returning(cls)
+        )
+        return session.scalars(
+            stmt, execution_options={"populate_existing": True}
+        ).one()